@@ -4,17 +4,33 @@
 Runs on Raspberry Pi or mini PC to manage 3D printer operations
 """
 
-import json
+import functools
+import gzip
+import hashlib
 import time
 import logging
 import os
+import queue
+import sched
+import shutil
+import signal
+import socket
+import ssl
 import subprocess
-from typing import Dict, Any
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Any, List, Tuple
 import boto3
-from botocore.exceptions import ClientError
+import orjson
+from boto3.s3.transfer import TransferConfig
+from botocore.client import Config
+from botocore.exceptions import BotoCoreError, ClientError
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timezone
 
 # Configure logging
 logging.basicConfig(
@@ -23,6 +39,125 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class RateLimitFilter(logging.Filter):
+    """Drops a record that repeats the logger's previous message within window seconds"""
+    
+    def __init__(self, window: float = 5.0):
+        super().__init__()
+        self.window = window
+        self._last: Dict[str, Tuple[int, float]] = {}
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = hash((record.levelno, record.getMessage()))
+        now = time.monotonic()
+        
+        last = self._last.get(record.name)
+        if last and last[0] == key and now - last[1] < self.window:
+            return False
+        
+        self._last[record.name] = (key, now)
+        return True
+
+logger.addFilter(RateLimitFilter())
+
+# One botocore session per process; clients built from it share credentials
+# resolution and keep their connection pools warm between calls
+_SESSION = boto3.session.Session()
+_CLIENT_CONFIG = Config(
+    max_pool_connections=50,
+    retries={'max_attempts': 3, 'mode': 'adaptive'},
+    tcp_keepalive=True
+)
+
+# Large G-code/STL files are fetched as parallel byte-range GETs
+_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True
+)
+
+# Files below the multipart threshold are streamed from a single GET in
+# 1 MiB chunks; files up to _SHM_MAX_BYTES are kept in RAM-backed /dev/shm
+_COPY_CHUNK = 1024 * 1024
+_SHM_MAX_BYTES = 64 * 1024 * 1024
+
+# Outgoing MQTT messages are coalesced per topic into one JSON array publish
+_PUBLISH_MAX_MESSAGES = 16
+_PUBLISH_MAX_DELAY = 0.05  # seconds
+
+# Batches larger than this are gzipped and sent on the topic's /gz subtopic
+_GZIP_MIN_BYTES = 256
+
+# MQTT keepalive, and how long the broker may hold undelivered telemetry
+_MQTT_KEEPALIVE = 30  # seconds
+_TELEMETRY_EXPIRY = 60  # seconds
+
+# The IoT data endpoint is stable per account and region, so it is cached
+# on disk instead of being looked up on every start
+_ENDPOINT_CACHE = os.getenv('IOT_ENDPOINT_CACHE', '/var/lib/printer/iot_endpoint')
+_ENDPOINT_CACHE_TTL = 24 * 60 * 60  # seconds
+
+# SCHED_FIFO priority of the MQTT network thread (needs CAP_SYS_NICE)
+_MQTT_RT_PRIORITY = 10
+
+# MQTT QoS per published event: telemetry and progress ticks tolerate drops,
+# job lifecycle transitions need an acknowledged delivery. 'started' is the
+# initial "printing" update. QoS 2 is never used.
+_QOS_BY_EVENT = {
+    'status': 0,
+    'printing': 0,
+    'started': 1,
+    'completed': 1,
+    'cancelled': 1,
+    'failed': 1
+}
+
+# Seconds between simulated progress ticks and simulated status updates
+_PROGRESS_INTERVAL = 10
+_STATUS_INTERVAL = 30
+
+@functools.lru_cache(maxsize=128)
+def _parse_s3(file_url: str) -> Tuple[str, str]:
+    """Split an s3://bucket/key (or https://host/key) URL into bucket and key"""
+    # Not urlsplit: '#' and '?' are legal in S3 keys
+    bucket, _, key = file_url.split('://', 1)[-1].partition('/')
+    return bucket, key
+
+def _log_task_error(future: Future):
+    """Log an exception that escaped a task run on an executor"""
+    if not future.cancelled() and future.exception():
+        logger.error("Background task failed: %s", future.exception())
+
+def _split_cpus() -> Tuple[set, set]:
+    """Split usable CPUs into a core for the MQTT network thread and the rest"""
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return set(), set()
+    
+    # A single core has nothing to isolate
+    if len(cpus) < 2:
+        return set(), set()
+    return {cpus[0]}, set(cpus[1:])
+
+def _pin_thread(cpus: set, realtime: bool = False) -> bool:
+    """Pin the calling thread to cpus, optionally with a real-time policy"""
+    if not cpus:
+        return False
+    try:
+        if realtime:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(_MQTT_RT_PRIORITY))
+        else:
+            # Threads inherit the policy of the thread that spawned them
+            os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+        # Pin only once the policy took, so a failure leaves the thread as it was
+        os.sched_setaffinity(0, cpus)
+    except OSError as e:
+        logger.warning("Could not set thread scheduling: %s", e)
+        return False
+    return True
+
 @dataclass
 class PrinterStatus:
     """Represents the current status of a 3D printer"""
@@ -34,76 +169,96 @@ class PrinterStatus:
     error_message: str = ""
     last_seen: datetime = None
 
+class TimerThread:
+    """Runs every periodic task on one daemon thread via a sched.scheduler"""
+    
+    def __init__(self):
+        self._sched = sched.scheduler(time.monotonic, self._delay)
+        self._wakeup = threading.Event()
+        threading.Thread(target=self._run, name='timers', daemon=True).start()
+    
+    def call_at(self, when: float, action, *args) -> sched.Event:
+        """Schedule action(*args) at a time.monotonic() deadline"""
+        event = self._sched.enterabs(when, 1, action, args)
+        # Wake the worker in case this deadline is earlier than the one it waits on
+        self._wakeup.set()
+        return event
+    
+    def cancel(self, event: sched.Event):
+        """Cancel a pending event; events that already ran are ignored"""
+        try:
+            self._sched.cancel(event)
+        except ValueError:
+            pass
+    
+    def _delay(self, timeout: float):
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+    
+    def _run(self):
+        while True:
+            try:
+                self._sched.run()
+            except Exception as e:
+                logger.error("Timer task failed: %s", e)
+                continue
+            
+            # Queue is empty; sleep until something is scheduled
+            self._wakeup.wait()
+            self._wakeup.clear()
+
 class PrinterEdgeClient:
-    def __init__(self, printer_id: str, aws_region: str = "us-east-1"):
+    def __init__(self, printer_id: str, gateway: 'PrinterGateway'):
         self.printer_id = printer_id
-        self.aws_region = aws_region
+        self.gateway = gateway
         self.status = PrinterStatus(printer_id=printer_id, status="offline")
         self.current_job = None
+        self._timers = gateway.timers
         
-        # AWS IoT Core client
-        self.iot_client = boto3.client('iot', region_name=aws_region)
-        
-        # S3 client for downloading files
-        self.s3_client = boto3.client('s3', region_name=aws_region)
-        
-        # MQTT client for IoT Core communication
-        self.mqtt_client = mqtt.Client()
-        self.mqtt_client.on_connect = self.on_mqtt_connect
-        self.mqtt_client.on_message = self.on_mqtt_message
-        self.mqtt_client.on_disconnect = self.on_mqtt_disconnect
+        # current_job is read and replaced from the MQTT thread, the download
+        # workers and the timer thread
+        self._job_lock = threading.Lock()
         
-        # Get IoT endpoint
-        try:
-            response = self.iot_client.describe_endpoint(endpointType='iot:Data-ATS')
-            self.iot_endpoint = response['endpointAddress']
-        except ClientError as e:
-            logger.error(f"Failed to get IoT endpoint: {e}")
-            raise
-        
-        logger.info(f"Initialized printer client for printer {printer_id}")
-    
-    def on_mqtt_connect(self, client, userdata, flags, rc):
-        """Called when MQTT client connects"""
-        logger.info(f"Connected to AWS IoT Core with result code {rc}")
+        # Outgoing payloads are built once and only their changing fields are
+        # updated per publish; the lock covers publishers on different threads
+        self._status_topic = f"3dprinter/{printer_id}/status"
+        self._job_status_topic = f"3dprinter/{printer_id}/job_status"
+        self._status_tpl = {
+            'printer_id': printer_id,
+            'status': '',
+            'temperature': 0.0,
+            'material_level': 0.0,
+            'current_material': '',
+            'error_message': '',
+            'last_seen': None,
+            'timestamp': None
+        }
+        self._job_status_tpl = {
+            'job_id': '',
+            'printer_id': printer_id,
+            'status': '',
+            'progress': 0,
+            'error': None,
+            'timestamp': None
+        }
+        self._tpl_lock = threading.Lock()
         
-        # Subscribe to printer-specific topics
-        topics = [
-            f"3dprinter/{self.printer_id}/jobs",
-            f"3dprinter/{self.printer_id}/commands",
-            f"3dprinter/{self.printer_id}/config"
-        ]
+        # S3 client, download pool and in-flight downloads are shared across
+        # the gateway
+        self.s3_client = gateway.s3_client
+        self._dl_pool = gateway.download_pool
         
-        for topic in topics:
-            client.subscribe(topic)
-            logger.info(f"Subscribed to {topic}")
-    
-    def on_mqtt_message(self, client, userdata, msg):
-        """Called when MQTT message is received"""
-        try:
-            payload = json.loads(msg.payload.decode())
-            logger.info(f"Received message on {msg.topic}: {payload}")
-            
-            if "jobs" in msg.topic:
-                self.handle_job_message(payload)
-            elif "commands" in msg.topic:
-                self.handle_command_message(payload)
-            elif "config" in msg.topic:
-                self.handle_config_message(payload)
-                
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to parse MQTT message: {e}")
-        except Exception as e:
-            logger.error(f"Error handling MQTT message: {e}")
-    
-    def on_mqtt_disconnect(self, client, userdata, rc):
-        """Called when MQTT client disconnects"""
-        logger.warning(f"Disconnected from AWS IoT Core with result code {rc}")
+        logger.info("Initialized printer client for printer %s", printer_id)
     
     def handle_job_message(self, payload: Dict[str, Any]):
         """Handle print job messages"""
         job_type = payload.get('type')
         
+        # Fetch the file as soon as any job message names it, so the download
+        # overlaps with the current print instead of delaying the next one
+        if 'file_url' in payload:
+            self.prefetch_file(payload['file_url'])
+        
         if job_type == 'start':
             self.start_print_job(payload)
         elif job_type == 'pause':
@@ -127,88 +282,156 @@ class PrinterEdgeClient:
     
     def handle_config_message(self, payload: Dict[str, Any]):
         """Handle configuration updates"""
-        logger.info(f"Received config update: {payload}")
+        logger.info("Received config update: %s", payload)
         # Update printer configuration
         if 'material' in payload:
             self.status.current_material = payload['material']
     
     def start_print_job(self, job_data: Dict[str, Any]):
-        """Start a new print job"""
+        """Make job_data the current job and start it once its file is downloaded"""
+        job_id = job_data['job_id']
+        file_url = job_data.get('file_url')
+        if not file_url:
+            logger.error("Print job %s has no file_url", job_id)
+            self.publish_job_status(job_id, "failed", 0, "Missing file_url")
+            return
+        
+        logger.info("Starting print job %s with file %s", job_id, file_url)
+        
+        # The job becomes current here, in message order, so a cancel that
+        # arrives while its file is still downloading applies to it
+        job = {
+            'job_id': job_id,
+            'material': job_data.get('material', 'PLA'),
+            'file_url': file_url,
+            'download': self.prefetch_file(file_url),
+            'progress': 0
+        }
+        with self._job_lock:
+            previous = self.current_job
+            self.current_job = job
+            if previous:
+                self._end_job(previous, "cancelled", f"Superseded by job {job_id}")
+        
+        # Queued behind its own download, so this worker never waits on
+        # a download that is still stuck in the pool queue
+        started = self._dl_pool.submit(self._run_print_job, job)
+        started.add_done_callback(_log_task_error)
+    
+    def _run_print_job(self, job: Dict[str, Any]):
+        """Wait for the job's file and start printing it, unless it was cancelled meanwhile"""
+        job_id = job['job_id']
         try:
-            job_id = job_data['job_id']
-            file_url = job_data['file_url']
-            material = job_data.get('material', 'PLA')
-            
-            logger.info(f"Starting print job {job_id} with file {file_url}")
-            
-            # Download file from S3
-            local_file = self.download_file_from_s3(file_url)
+            # Wait for the prefetch. If it failed, download here; a finished
+            # file is revalidated by ETag.
+            local_file = job['download'].result()
+            if not local_file:
+                local_file = self.download_file_from_s3(job['file_url'])
             
-            if local_file:
+            with self._job_lock:
+                if self.current_job is not job:
+                    logger.info("Print job %s was cancelled before it started", job_id)
+                    return
+                
+                if not local_file:
+                    logger.error("Failed to download file for job %s", job_id)
+                    self.current_job = None
+                    self._end_job(job, "failed", "Failed to download file")
+                    return
+                
                 # Update status
                 self.status.status = "printing"
-                self.current_job = {
-                    'job_id': job_id,
-                    'file_path': local_file,
-                    'material': material,
-                    'start_time': datetime.now()
-                }
-                
-                # Start the print (this would integrate with your printer's API)
-                self.start_print(local_file, material)
+                job['file_path'] = local_file
+                job['start_time'] = datetime.now()
                 
                 # Publish status update
-                self.publish_job_status(job_id, "printing", 0)
-            else:
-                logger.error(f"Failed to download file for job {job_id}")
-                self.publish_job_status(job_id, "failed", 0, "Failed to download file")
-                
+                self.publish_job_status(job_id, "printing", 0, qos=_QOS_BY_EVENT['started'])
+            
+            # Start the print (this would integrate with your printer's API)
+            self.start_print(job)
+            
         except Exception as e:
-            logger.error(f"Error starting print job: {e}")
-            self.publish_job_status(job_id, "failed", 0, str(e))
+            logger.error("Error starting print job: %s", e)
+            with self._job_lock:
+                if self.current_job is job:
+                    self.current_job = None
+                    self._end_job(job, "failed", str(e))
+    
+    def prefetch_file(self, file_url: str) -> Future:
+        """Start downloading a file in the background, reusing a pending download"""
+        return self.gateway.prefetch(file_url, self.download_file_from_s3)
     
     def download_file_from_s3(self, file_url: str) -> str:
         """Download file from S3 to local storage"""
         try:
-            # Parse S3 URL (s3://bucket/key)
-            if file_url.startswith('s3://'):
-                parts = file_url[5:].split('/', 1)
-                bucket = parts[0]
-                key = parts[1]
-            else:
-                # Assume it's a direct S3 URL
-                parts = file_url.split('/')
-                bucket = parts[2]
-                key = '/'.join(parts[3:])
+            bucket, key = _parse_s3(file_url)
+            head = self.s3_client.head_object(Bucket=bucket, Key=key)
+            etag = head['ETag']
+            size = head['ContentLength']
             
             # Create local directory
-            os.makedirs('/tmp/prints', exist_ok=True)
+            in_ram = size <= _SHM_MAX_BYTES and os.path.isdir('/dev/shm')
+            download_dir = '/dev/shm/prints' if in_ram else '/tmp/prints'
+            os.makedirs(download_dir, exist_ok=True)
+            # Keys from different buckets or prefixes may share a basename;
+            # a digest of the full location keeps their local copies apart
+            digest = hashlib.sha1(f"{bucket}/{key}".encode()).hexdigest()[:16]
+            local_file = f"{download_dir}/{digest}-{os.path.basename(key)}"
+            
+            # Reprints of the same object reuse the local copy; the ETag of the
+            # last download is kept next to the file
+            etag_file = f"{local_file}.etag"
+            try:
+                with open(etag_file) as f:
+                    cached_etag = f.read()
+            except OSError:
+                cached_etag = None
+            
+            if cached_etag == etag and os.path.exists(local_file):
+                logger.info("Using cached file %s", local_file)
+                return local_file
             
             # Download file
-            local_file = f"/tmp/prints/{os.path.basename(key)}"
-            self.s3_client.download_file(bucket, key, local_file)
+            if size < _TRANSFER_CONFIG.multipart_threshold:
+                # Stream into a uniquely named temporary file so a failed or
+                # concurrent transfer never leaves a partial file behind under
+                # the final name
+                fd, partial_file = tempfile.mkstemp(dir=download_dir, suffix='.part')
+                try:
+                    with os.fdopen(fd, 'wb', buffering=_COPY_CHUNK) as f:
+                        response = self.s3_client.get_object(Bucket=bucket, Key=key, IfMatch=etag)
+                        shutil.copyfileobj(response['Body'], f, length=_COPY_CHUNK)
+                    os.replace(partial_file, local_file)
+                except BaseException:
+                    os.unlink(partial_file)
+                    raise
+            else:
+                self.s3_client.download_file(bucket, key, local_file, Config=_TRANSFER_CONFIG)
+            
+            with open(etag_file, 'w') as f:
+                f.write(etag)
             
-            logger.info(f"Downloaded file to {local_file}")
+            logger.info("Downloaded file to %s", local_file)
             return local_file
             
         except Exception as e:
-            logger.error(f"Failed to download file from S3: {e}")
+            logger.error("Failed to download file from S3: %s", e)
             return None
     
-    def start_print(self, file_path: str, material: str):
+    def start_print(self, job: Dict[str, Any]):
         """Start the actual print process"""
         # This would integrate with your specific 3D printer's API
         # For example, using OctoPrint, Repetier, or direct G-code
         
-        logger.info(f"Starting print of {file_path} with {material}")
+        logger.info("Starting print of %s with %s", job['file_path'], job['material'])
         
         # Example: Send to OctoPrint API
-        # self.send_to_octoprint(file_path, material)
+        # self.send_to_octoprint(job['file_path'], job['material'])
         
         # For now, just simulate the print process
-        self.simulate_print_process(file_path, material)
+        self.simulate_print_process(job)
     
-    def simulate_print_process(self, file_path: str, material: str):
+    def simulate_print_process(self, job: Dict[str, Any]):
         """Simulate the print process for testing"""
         logger.info("Simulating print process...")
         
@@ -218,72 +441,377 @@ class PrinterEdgeClient:
         # 3. Update status periodically
         # 4. Handle errors and completion
         
-        # For simulation, we'll just update progress every 10 seconds
-        import threading
-        
-        def progress_updater():
-            progress = 0
-            while progress < 100 and self.current_job:
-                time.sleep(10)
-                progress += 10
-                self.publish_job_status(
-                    self.current_job['job_id'], 
-                    "printing", 
-                    progress
-                )
-                
-                if progress >= 100:
-                    self.complete_print_job()
-                    break
-        
-        threading.Thread(target=progress_updater, daemon=True).start()
+        # For simulation, we'll just update progress every 10 seconds.
+        # Ticks are scheduled off a monotonic deadline so they don't drift.
+        deadline = time.monotonic() + _PROGRESS_INTERVAL
+        with self._job_lock:
+            if self.current_job is job:
+                job['timer'] = self._timers.call_at(deadline, self._progress_tick, job, deadline)
     
-    def complete_print_job(self):
-        """Complete the current print job"""
-        if self.current_job:
-            logger.info(f"Completing print job {self.current_job['job_id']}")
+    def _progress_tick(self, job: Dict[str, Any], deadline: float):
+        """Advance simulated progress for job and schedule the next tick"""
+        with self._job_lock:
+            # The job may have been cancelled or replaced since this tick was queued
+            if self.current_job is not job:
+                return
             
-            self.status.status = "online"
-            self.current_job = None
+            job['progress'] += 10
+            self.publish_job_status(job['job_id'], "printing", job['progress'])
             
-            # Publish completion status
-            self.publish_job_status(
-                self.current_job['job_id'], 
-                "completed", 
-                100
-            )
+            if job['progress'] < 100:
+                deadline += _PROGRESS_INTERVAL
+                job['timer'] = self._timers.call_at(deadline, self._progress_tick, job, deadline)
+                return
+        
+        self.complete_print_job(job)
+    
+    def cancel_print_job(self):
+        """Cancel the current print job, whether it is printing or still downloading"""
+        with self._job_lock:
+            job = self.current_job
+            if job:
+                logger.info("Cancelling print job %s", job['job_id'])
+                self.current_job = None
+                self._end_job(job, "cancelled")
+    
+    def complete_print_job(self, job: Dict[str, Any]):
+        """Complete job if it is still the current print job"""
+        with self._job_lock:
+            if self.current_job is not job:
+                return
+            logger.info("Completing print job %s", job['job_id'])
+            self.current_job = None
+            self._end_job(job, "completed")
+    
+    def _end_job(self, job: Dict[str, Any], status: str, error: str = None):
+        """Stop a job that is no longer current and publish its final status; needs _job_lock"""
+        if 'timer' in job:
+            self._timers.cancel(job['timer'])
+        self.status.status = "online"
+        
+        progress = 100 if status == "completed" else job['progress']
+        self.publish_job_status(job['job_id'], status, progress, error)
+    
+    def connect_simulated(self):
+        """Mark the printer online and publish simulated status updates"""
+        self.status.status = "online"
+        self.status.last_seen = datetime.now()
+        
+        # Simulate periodic status updates
+        deadline = time.monotonic() + _STATUS_INTERVAL
+        self._timers.call_at(deadline, self._status_tick, deadline)
+    
+    def _status_tick(self, deadline: float):
+        """Publish simulated status and schedule the next update"""
+        self.publish_status()
+        deadline += _STATUS_INTERVAL
+        self._timers.call_at(deadline, self._status_tick, deadline)
     
     def publish_status(self):
         """Publish current printer status"""
-        status_message = {
-            'printer_id': self.printer_id,
-            'status': self.status.status,
-            'temperature': self.status.temperature,
-            'material_level': self.status.material_level,
-            'current_material': self.status.current_material,
-            'error_message': self.status.error_message,
-            'last_seen': datetime.now().isoformat(),
-            'timestamp': datetime.now().isoformat()
-        }
+        ts = datetime.now(timezone.utc)
+        with self._tpl_lock:
+            status_message = self._status_tpl
+            status_message['status'] = self.status.status
+            status_message['temperature'] = self.status.temperature
+            status_message['material_level'] = self.status.material_level
+            status_message['current_material'] = self.status.current_material
+            status_message['error_message'] = self.status.error_message
+            status_message['last_seen'] = ts
+            status_message['timestamp'] = ts
+            payload = orjson.dumps(status_message, option=orjson.OPT_UTC_Z)
+            logger.info("Published status: %s", status_message)
         
-        topic = f"3dprinter/{self.printer_id}/status"
-        self.mqtt_client.publish(topic, json.dumps(status_message))
-        logger.info(f"Published status: {status_message}")
+        self.gateway.publish(self._status_topic, _QOS_BY_EVENT['status'], payload)
     
-    def publish_job_status(self, job_id: str, status: str, progress: int, error: str = None):
+    def publish_job_status(self, job_id: str, status: str, progress: int, error: str = None,
+                           qos: int = None):
         """Publish job status update"""
-        status_message = {
-            'job_id': job_id,
-            'printer_id': self.printer_id,
-            'status': status,
-            'progress': progress,
-            'error': error,
-            'timestamp': datetime.now().isoformat()
+        ts = datetime.now(timezone.utc)
+        with self._tpl_lock:
+            status_message = self._job_status_tpl
+            status_message['job_id'] = job_id
+            status_message['status'] = status
+            status_message['progress'] = progress
+            status_message['error'] = error
+            status_message['timestamp'] = ts
+            payload = orjson.dumps(status_message, option=orjson.OPT_UTC_Z)
+            logger.info("Published job status: %s", status_message)
+        
+        if qos is None:
+            qos = _QOS_BY_EVENT.get(status, 1)
+        self.gateway.publish(self._job_status_topic, qos, payload)
+
+class PrinterGateway:
+    """Serves every printer on this host over a single MQTT connection"""
+    
+    def __init__(self, printer_ids: List[str], aws_region: str = "us-east-1"):
+        self.aws_region = aws_region
+        
+        # AWS IoT Core client
+        self.iot_client = _SESSION.client('iot', region_name=aws_region, config=_CLIENT_CONFIG)
+        
+        # S3 client for downloading files
+        self.s3_client = _SESSION.client('s3', region_name=aws_region, config=_CLIENT_CONFIG)
+        
+        # Background downloads and periodic tasks for all printers. Once the
+        # MQTT network thread has its own core, downloads stay off it.
+        self._mqtt_cpus, self._spare_cpus = _split_cpus()
+        self._worker_cpus: set = set()
+        self.download_pool = ThreadPoolExecutor(
+            max_workers=4,
+            thread_name_prefix='s3-download',
+            initializer=self._pin_worker_thread
+        )
+        self.timers = TimerThread()
+        
+        # In-flight downloads, keyed by file URL, so printers that name the
+        # same file share one transfer and a job waits for its prefetch
+        self._downloads: Dict[str, Future] = {}
+        self._downloads_lock = threading.Lock()
+        
+        # MQTT 5 client for IoT Core communication. IoT policies usually tie
+        # the client id to a thing name, so the first printer's id is used.
+        self.mqtt_client = mqtt.Client(client_id=printer_ids[0], protocol=mqtt.MQTTv5)
+        self.mqtt_client.on_connect = self.on_mqtt_connect
+        self.mqtt_client.on_message = self.on_mqtt_message
+        self.mqtt_client.on_disconnect = self.on_mqtt_disconnect
+        self.mqtt_client.on_connect_fail = self.on_mqtt_connect_fail
+        
+        # Messages are serialized by the caller and sent by a single publisher
+        # thread, which batches whatever arrives within a short window
+        self._pub_q: queue.Queue = queue.Queue()
+        self._publisher = threading.Thread(target=self._publisher_loop, name='mqtt-publisher', daemon=True)
+        self._publisher.start()
+        
+        # Topic aliases are per connection and negotiated in CONNACK
+        self._topic_aliases: Dict[str, int] = {}
+        self._topic_alias_max = 0
+        self._alias_lock = threading.Lock()
+        
+        # Set to end run(); the main thread just waits on it
+        self._shutdown = threading.Event()
+        self._network_thread_pinned = False
+        
+        self.printers: Dict[str, PrinterEdgeClient] = {
+            printer_id: PrinterEdgeClient(printer_id, self) for printer_id in printer_ids
         }
         
-        topic = f"3dprinter/{self.printer_id}/job_status"
-        self.mqtt_client.publish(topic, json.dumps(status_message))
-        logger.info(f"Published job status: {status_message}")
+        # Incoming topics are known up front, so dispatch is a dict lookup
+        self._routes = {}
+        for printer_id, printer in self.printers.items():
+            self._routes[f"3dprinter/{printer_id}/jobs"] = printer.handle_job_message
+            self._routes[f"3dprinter/{printer_id}/commands"] = printer.handle_command_message
+            self._routes[f"3dprinter/{printer_id}/config"] = printer.handle_config_message
+        
+        # Get IoT endpoint
+        try:
+            self.iot_endpoint = self._resolve_endpoint()
+        except (ClientError, BotoCoreError) as e:
+            logger.error("Failed to get IoT endpoint: %s", e)
+            raise
+        
+        logger.info("Initialized gateway for printers %s", ', '.join(self.printers))
+    
+    def _resolve_endpoint(self, refresh: bool = False) -> str:
+        """Return the IoT data endpoint, preferring a fresh on-disk cache"""
+        cached, fresh = None, False
+        if not refresh:
+            try:
+                fresh = time.time() - os.path.getmtime(_ENDPOINT_CACHE) < _ENDPOINT_CACHE_TTL
+                with open(_ENDPOINT_CACHE) as f:
+                    cached = f.read().strip() or None
+            except OSError:
+                pass
+            
+            if cached and fresh:
+                self._endpoint_from_cache = True
+                return cached
+        
+        try:
+            response = self.iot_client.describe_endpoint(endpointType='iot:Data-ATS')
+        except (ClientError, BotoCoreError) as e:
+            if not cached:
+                raise
+            # Offline with an expired cache: the endpoint rarely changes, so
+            # use it and let on_mqtt_connect_fail refresh it if it is wrong
+            logger.warning("Using expired cached IoT endpoint: %s", e)
+            self._endpoint_from_cache = True
+            return cached
+        
+        endpoint = response['endpointAddress']
+        self._endpoint_from_cache = False
+        
+        try:
+            os.makedirs(os.path.dirname(_ENDPOINT_CACHE), exist_ok=True)
+            with open(_ENDPOINT_CACHE, 'w') as f:
+                f.write(endpoint)
+        except OSError as e:
+            logger.warning("Could not cache IoT endpoint: %s", e)
+        
+        return endpoint
+    
+    def prefetch(self, file_url: str, fetch) -> Future:
+        """Run fetch(file_url) on the download pool unless it is already in flight"""
+        with self._downloads_lock:
+            download = self._downloads.get(file_url)
+            if download is not None:
+                return download
+            download = self.download_pool.submit(fetch, file_url)
+            self._downloads[file_url] = download
+        
+        # Only in-flight downloads are tracked; the finished file stays cached
+        # on disk. Added outside the lock as it may run immediately.
+        download.add_done_callback(lambda d: self._forget_download(file_url, d))
+        return download
+    
+    def _forget_download(self, file_url: str, download: Future):
+        """Stop tracking a download once it has finished"""
+        with self._downloads_lock:
+            if self._downloads.get(file_url) is download:
+                del self._downloads[file_url]
+    
+    def _pin_worker_thread(self):
+        """Keep a new download worker off the MQTT core, if that core is reserved"""
+        _pin_thread(self._worker_cpus)
+    
+    def publish(self, topic: str, qos: int, payload: bytes):
+        """Queue a serialized message for the publisher thread"""
+        self._pub_q.put((topic, qos, payload))
+    
+    def on_mqtt_connect(self, client, userdata, flags, rc, properties=None):
+        """Called when MQTT client connects"""
+        logger.info("Connected to AWS IoT Core with result code %s", rc)
+        
+        # on_connect runs on paho's network thread
+        if not self._network_thread_pinned:
+            if _pin_thread(self._mqtt_cpus, realtime=True):
+                self._worker_cpus = self._spare_cpus
+            self._network_thread_pinned = True
+        
+        # Aliases from a previous connection are meaningless to the broker now
+        with self._alias_lock:
+            self._topic_aliases = {}
+            self._topic_alias_max = getattr(properties, 'TopicAliasMaximum', 0)
+        
+        # Send small PUBLISH frames immediately rather than letting Nagle hold
+        # back-to-back packets until the previous one is acked
+        sock = client.socket()
+        if sock:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        
+        # Subscribe to the topics of every printer behind this gateway in one
+        # request; explicit ids keep other gateways' traffic off this link
+        topics = list(self._routes)
+        client.subscribe([(topic, 0) for topic in topics])
+        logger.info("Subscribed to %s", ', '.join(topics))
+    
+    def on_mqtt_message(self, client, userdata, msg):
+        """Called when MQTT message is received"""
+        # Route on the topic first so frames nobody handles are never decoded
+        topic = msg.topic
+        handler = self._routes.get(topic)
+        if handler is None:
+            return
+        
+        try:
+            payload = orjson.loads(msg.payload)
+            logger.info("Received message on %s: %s", topic, payload)
+            handler(payload)
+                
+        except orjson.JSONDecodeError as e:
+            logger.error("Failed to parse MQTT message: %s", e)
+        except Exception as e:
+            logger.error("Error handling MQTT message: %s", e)
+    
+    def on_mqtt_disconnect(self, client, userdata, rc, properties=None):
+        """Called when MQTT client disconnects"""
+        logger.warning("Disconnected from AWS IoT Core with result code %s", rc)
+        
+        # No aliases until the next CONNACK: paho sends CONNECT on reconnect
+        # before the broker answers, and old aliases are invalid by then
+        with self._alias_lock:
+            self._topic_aliases = {}
+            self._topic_alias_max = 0
+    
+    def on_mqtt_connect_fail(self, client, userdata):
+        """Called when the network loop fails to open a connection"""
+        # A cached endpoint may be stale; look it up again, but only once so an
+        # offline device doesn't hammer the IoT control plane
+        if not self._endpoint_from_cache:
+            return
+        self._endpoint_from_cache = False
+        
+        try:
+            self.iot_endpoint = self._resolve_endpoint(refresh=True)
+        except (ClientError, BotoCoreError) as e:
+            logger.error("Failed to refresh IoT endpoint: %s", e)
+            return
+        
+        client.connect_async(self.iot_endpoint, 8883, _MQTT_KEEPALIVE)
+    
+    def _publisher_loop(self):
+        """Drain the publish queue, sending each topic's pending messages as one array per QoS"""
+        running = True
+        while running:
+            batch = [self._pub_q.get()]
+            deadline = time.monotonic() + _PUBLISH_MAX_DELAY
+            while len(batch) < _PUBLISH_MAX_MESSAGES and batch[-1] is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._pub_q.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            # A None entry is the shutdown sentinel; flush what came before it
+            if batch[-1] is None:
+                batch.pop()
+                running = False
+            
+            by_topic: Dict[tuple, list] = {}
+            for topic, qos, payload in batch:
+                by_topic.setdefault((topic, qos), []).append(payload)
+            
+            # A failed batch is logged and dropped; it must not take down the
+            # only publisher thread
+            for (topic, qos), payloads in by_topic.items():
+                try:
+                    self._publish_batch(topic, qos, b'[' + b','.join(payloads) + b']')
+                except Exception as e:
+                    logger.error("Failed to publish to %s: %s", topic, e)
+    
+    def _publish_batch(self, topic: str, qos: int, body: bytes):
+        """Publish one batch, compressing it and aliasing its topic where possible"""
+        properties = Properties(PacketTypes.PUBLISH)
+        if len(body) > _GZIP_MIN_BYTES:
+            body = gzip.compress(body, compresslevel=1)
+            topic = f"{topic}/gz"
+            properties.ContentType = 'application/gzip'
+        
+        if qos > 0:
+            self.mqtt_client.publish(topic, body, qos=qos, properties=properties)
+            return
+        
+        # Telemetry goes stale, and only QoS 0 messages are aliased: paho
+        # replays unacked QoS 1 packets verbatim after a reconnect, when
+        # their alias would no longer be valid
+        properties.MessageExpiryInterval = _TELEMETRY_EXPIRY
+        with self._alias_lock:
+            alias = self._topic_aliases.get(topic)
+            if alias:
+                # The broker already maps this alias to the full topic
+                properties.TopicAlias = alias
+                topic = ''
+            elif len(self._topic_aliases) < self._topic_alias_max:
+                # First use sends the full topic along with its new alias
+                alias = len(self._topic_aliases) + 1
+                self._topic_aliases[topic] = alias
+                properties.TopicAlias = alias
+            
+            self.mqtt_client.publish(topic, body, qos=qos, properties=properties)
     
     def connect(self):
         """Connect to AWS IoT Core"""
@@ -297,76 +825,84 @@ class PrinterEdgeClient:
                 logger.warning("Certificate files not found, using simulated mode")
                 return self.connect_simulated()
             
-            self.mqtt_client.tls_set(
-                ca_certs=ca_path,
-                certfile=cert_path,
-                keyfile=key_path,
-                cert_reqs=mqtt.ssl.CERT_REQUIRED,
-                tls_version=mqtt.ssl.PROTOCOL_TLSv1_2,
-                ciphers=None
-            )
+            # One TLS context, with certificates loaded once, for the first
+            # connection and every reconnect
+            tls_context = ssl.create_default_context(cafile=ca_path)
+            tls_context.minimum_version = ssl.TLSVersion.TLSv1_2
+            tls_context.load_cert_chain(certfile=cert_path, keyfile=key_path)
+            self.mqtt_client.tls_set_context(tls_context)
             
-            # Connect to IoT Core
-            self.mqtt_client.connect(self.iot_endpoint, 8883, 60)
+            # Connect to IoT Core from paho's network thread, which also
+            # handles reconnects and is the only thread writing to the socket
+            self.mqtt_client.connect_async(self.iot_endpoint, 8883, _MQTT_KEEPALIVE)
             self.mqtt_client.loop_start()
             
             # Update status
-            self.status.status = "online"
-            self.status.last_seen = datetime.now()
+            for printer in self.printers.values():
+                printer.status.status = "online"
+                printer.status.last_seen = datetime.now()
             
-            logger.info("Connected to AWS IoT Core")
+            logger.info("Connecting to AWS IoT Core")
             
         except Exception as e:
-            logger.error(f"Failed to connect to AWS IoT Core: {e}")
+            logger.error("Failed to connect to AWS IoT Core: %s", e)
             raise
     
     def connect_simulated(self):
         """Connect in simulated mode for testing"""
         logger.info("Running in simulated mode")
-        self.status.status = "online"
-        self.status.last_seen = datetime.now()
-        
-        # Simulate periodic status updates
-        import threading
-        
-        def status_updater():
-            while True:
-                time.sleep(30)
-                self.publish_status()
-        
-        threading.Thread(target=status_updater, daemon=True).start()
+        for printer in self.printers.values():
+            printer.connect_simulated()
     
     def run(self):
         """Main run loop"""
+        signal.signal(signal.SIGTERM, self.stop)
+        
         try:
             self.connect()
-            
-            # Main loop
-            while True:
-                time.sleep(1)
+            self._shutdown.wait()
                 
         except KeyboardInterrupt:
             logger.info("Shutting down...")
         except Exception as e:
-            logger.error(f"Error in main loop: {e}")
+            logger.error("Error in main loop: %s", e)
         finally:
             self.cleanup()
     
+    def stop(self, *args):
+        """Make run() return; also used as the SIGTERM handler"""
+        self._shutdown.set()
+    
     def cleanup(self):
         """Cleanup resources"""
+        # Flush queued messages before the connection goes away
+        self._pub_q.put(None)
+        self._publisher.join(timeout=1)
+        
         if self.mqtt_client:
-            self.mqtt_client.loop_stop()
             self.mqtt_client.disconnect()
+            self.mqtt_client.loop_stop()
+        
+        self.download_pool.shutdown(wait=False, cancel_futures=True)
         
         logger.info("Cleanup completed")
 
 def main():
     """Main entry point"""
-    printer_id = os.getenv('PRINTER_ID', 'printer-001')
+    # PRINTER_IDS lists every printer attached to this host, comma separated
+    printer_id = os.getenv('PRINTER_ID', 'printer-001').strip()
+    printer_ids = [p.strip() for p in os.getenv('PRINTER_IDS', '').split(',') if p.strip()]
     aws_region = os.getenv('AWS_REGION', 'us-east-1')
     
-    client = PrinterEdgeClient(printer_id, aws_region)
-    client.run()
+    # An unset, empty or comma-only PRINTER_IDS falls back to PRINTER_ID
+    if not printer_ids:
+        printer_ids = [printer_id] if printer_id else []
+    if not printer_ids:
+        logger.error("No printer ids configured; set PRINTER_IDS or PRINTER_ID")
+        raise SystemExit(1)
+    
+    gateway = PrinterGateway(printer_ids, aws_region)
+    gateway.run()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file